@@ -2,33 +2,88 @@
 A collection of functions for computing verification scores
 -------------------------------------------------------
 Content:
+    - binary_contingency()
     - ETS()
     - freq_bias()
+    - quantile_partition()
     - PIT_nan()
     - CRPS_1d_from_quantiles()
+    - quantile_steps()
+    - CRPS_1d_from_steps()
     - CRPS_1d()
+    - CRPS_1d_np()
+    - CRPS_1d_gpu()
+    - CRPS_1d_soa()
+    - CRPS_1d_pairwise_soa()
     - CRPS_2d()
+    - CRPS_2d_np()
+    - CRPS_2d_soa()
     - CRPS_1d_nan()
+    - CRPS_1d_nan_soa()
     - BS_binary_1d()
+    - BS_binary_1d_gpu()
+    - BS_binary_core()
     - BS_binary_1d_nan()
     - score_bootstrap_1d()
     - bootstrap_confidence_intervals()
+    - map_pyshtools_serial()
     - zonal_energy_spectrum_sph()
     
+* Numba kernels with the `_soa` suffix take ensemble members as the last dimension,
+  e.g., `shape=(time, grids, ensemble_members)`, so each member vector is contiguous.
+    
 Yingkai Sha
 ksha@ucar.edu
 '''
 
+import threading
+
 import numba as nb
+from numba import prange
 import numpy as np
 import xarray as xr
 import pyshtools
 
+# optional GPU backend
+try:
+    import cupy as cp
+except ImportError:
+    cp = None
+
+# numba fastmath flags without 'nnan' and 'ninf', so np.isnan checks are kept
+FASTMATH_NAN = {'nsz', 'arcp', 'contract', 'afn', 'reassoc'}
+
+# tile size of the pairwise member loop in CRPS_1d_pairwise_soa,
+# two tiles of float64 (2*32*8 bytes) stay in L1 cache
+PAIRWISE_BLOCK = 32
+
+# pyshtools transforms are not thread-safe, calls are serialized within each process
+PYSHTOOLS_LOCK = threading.Lock()
+
+# CRPS_2d(impl='auto') uses the numpy path when its peak memory is below this many bytes;
+# the peak is counted as 3 float64 arrays of y_ens size: y_ens, |y_true - y_ens|, and sorted y_ens
+CRPS_2D_NP_MAX_BYTES = 2*2**30
+
+def binary_contingency(TRUE, PRED):
+    '''
+    Counting true negatives, false positives, false negatives, and true positives
+    from binary input and target. Same order as confusion_matrix(TRUE, PRED).ravel().
+    '''
+    TRUE = np.asarray(TRUE, dtype=bool).ravel()
+    PRED = np.asarray(PRED, dtype=bool).ravel()
+    
+    TP = np.count_nonzero(TRUE & PRED)
+    FP = np.count_nonzero(PRED) - TP
+    FN = np.count_nonzero(TRUE) - TP
+    TN = TRUE.size - TP - FP - FN
+    
+    return TN, FP, FN, TP
+
 def ETS(TRUE, PRED):
     '''
     Computing Equitable Threat Score (ETS) from binary input and target.
     '''
-    TN, FP, FN, TP = confusion_matrix(TRUE, PRED).ravel()
+    TN, FP, FN, TP = binary_contingency(TRUE, PRED)
     TP_rnd = (TP+FN)*(TP+FP)/(TN+FP+FN+TP)
     return (TP-TP_rnd)/(TP+FN+FP-TP_rnd)
 
@@ -36,28 +91,53 @@ def freq_bias(TRUE, PRED):
     '''
     Computing frequency bias from binary input and target.
     '''
-    TN, FP, FN, TP = confusion_matrix(TRUE, PRED).ravel()
+    TN, FP, FN, TP = binary_contingency(TRUE, PRED)
     return (TP+FP)/(TP+FN)
 
-def PIT_nan(fcst, obs, q_bins):
+def quantile_partition(a, q_bins):
+    '''
+    Same as np.quantile(a, q_bins) with linear interpolation, but only the order
+    statistics next to each quantile are selected (np.partition, O(n)),
+    instead of sorting the whole (flattened) array.
+    '''
+    a = np.ravel(a)
+    q_bins = np.asarray(q_bins)
+    
+    # np.partition moves np.nan to the end, np.quantile returns np.nan instead
+    if np.isnan(a).any():
+        return np.full(q_bins.shape, np.nan)[()]
+    
+    # virtual index of each quantile and its two neighbours
+    h = q_bins*(len(a)-1)
+    ind_lo = np.floor(h).astype(np.intp)
+    ind_hi = np.minimum(ind_lo+1, len(a)-1)
+    
+    # ravel so that scalar q_bins also work, the result keeps the shape of q_bins
+    part = np.partition(a, np.unique(np.concatenate((np.ravel(ind_lo), np.ravel(ind_hi)))))
+    
+    return part[ind_lo] + (h-ind_lo)*(part[ind_hi]-part[ind_lo])
+
+def PIT_nan(fcst, obs, q_bins, flag_nan=None):
     '''
     Probability Integral Transform (PIT) of observations based on forecast
+    
+    flag_nan: precomputed np.isnan(obs), can be shared by callers that reuse the same obs
     '''
-    obs = obs[~np.isnan(obs)]
+    if flag_nan is None:
+        flag_nan = np.isnan(obs)
     
     # CDF_fcst
-    cdf_fcst = np.quantile(fcst, q_bins)
+    cdf_fcst = quantile_partition(fcst, q_bins)
     
     # transforming obs to CDF_fcst 
-    n_obs = np.searchsorted(cdf_fcst, obs)
+    n_obs = np.searchsorted(cdf_fcst, np.asarray(obs)[~flag_nan])
     # an uniform distributed random variale
     p_obs = n_obs/len(q_bins)
     # estimate CDF_fcst(obs)
-    p_bins = np.quantile(p_obs, q_bins)
+    p_bins = quantile_partition(p_obs, q_bins)
     
     return p_bins
     
-@nb.njit()
 def CRPS_1d_from_quantiles(q_bins, CDFs, y_true):
     '''
     (experimental)
@@ -78,37 +158,79 @@ def CRPS_1d_from_quantiles(q_bins, CDFs, y_true):
       This is commonly applied for climatology CDFs vs. real-time obs. 
     
     '''
+    q_bins = np.asarray(q_bins, dtype=np.float64)
+    CDFs = np.asarray(CDFs, dtype=np.float64)
+    y_true = np.asarray(y_true, dtype=np.float64)
     
-    L = len(q_bins)-1
-    H_func = np.zeros((L+1,))
-    d_bins = q_bins[1] - q_bins[0]
+    # position of each obs on its CDF, searched for all days at once
+    steps = quantile_steps(CDFs, y_true)
+    
+    return CRPS_1d_from_steps(q_bins, CDFs, steps)
+
+@nb.njit('i8[:, ::1](f8[:, :], f8[:, :])',
+         parallel=True, cache=True, boundscheck=False)
+def quantile_steps(CDFs, y_true):
+    '''
+    Search the position of `y_true[:, n]` on `CDFs[:, n]` for each grid point.
+    Positions are capped at `num_bins-1`.
+    '''
+    L = CDFs.shape[0]-1
     
     N_days, N_grids = y_true.shape
     
+    steps = np.empty((N_days, N_grids), dtype=np.int64)
+    
+    for n in prange(N_grids):
+        steps[:, n] = np.minimum(np.searchsorted(CDFs[:, n], y_true[:, n]), L)
+        
+    return steps
+
+@nb.njit('f8[:, ::1](f8[:], f8[:, :], i8[:, ::1])',
+         parallel=True, fastmath=True, cache=True, boundscheck=False)
+def CRPS_1d_from_steps(q_bins, CDFs, steps):
+    '''
+    Numba version of CRPS_1d_from_quantiles, given obs positions from quantile_steps().
+    '''
+    
+    L = len(q_bins)-1
+    
+    N_days, N_grids = steps.shape
+    
+    # The trapezoid integral of (q_bins - H)**2 over the CDF, with H = 0 before
+    # `step` and H = 1 after, splits into segments that are known per grid point:
+    #     c0[k, n]: sum of the H = 0 segments before k
+    #     w_step[k, n]: the segment where H jumps from 0 to 1
+    #     c1[k, n]: sum of the H = 1 segments from k onward
+    c0 = np.zeros((L+1, N_grids))
+    w_step = np.empty((L, N_grids))
+    c1 = np.zeros((L+1, N_grids))
+    
+    for n in prange(N_grids):
+        for k in range(L):
+            d_cdf = 0.5*(CDFs[k+1, n] - CDFs[k, n])
+            c0[k+1, n] = c0[k, n] + d_cdf*(q_bins[k]**2 + q_bins[k+1]**2)
+            w_step[k, n] = d_cdf*(q_bins[k]**2 + (1-q_bins[k+1])**2)
+        for k in range(L-1, -1, -1):
+            d_cdf = 0.5*(CDFs[k+1, n] - CDFs[k, n])
+            c1[k, n] = c1[k+1, n] + d_cdf*((1-q_bins[k])**2 + (1-q_bins[k+1])**2)
+    
     CRPS = np.empty((N_days, N_grids))
     
-    for day in range(N_days):
+    for day in prange(N_days):
         for n in range(N_grids):
-            
-            cdf = CDFs[:, n]
-            obs = y_true[day, n]    
-            step = np.searchsorted(cdf, obs)
-            if step > L: step = L
-                
-            H_func[:] = 0.0
-            H_func[step:] = 1.0
-            
-            CRPS[day, n] = np.trapz((q_bins-H_func)**2, x=cdf)
-            #np.sum(np.diff(cdf)*(np.abs(q_bins-H_func)[:-1]))
+            step = steps[day, n]
+            if step == 0:
+                CRPS[day, n] = c1[0, n]
+            else:
+                CRPS[day, n] = c0[step-1, n] + w_step[step-1, n] + c1[step, n]
     
     return CRPS
 
-@nb.njit()
-def CRPS_1d(y_true, y_ens):
+def CRPS_1d(y_true, y_ens, device='cpu', pairwise=False, impl='numba'):
     '''
     Given one-dimensional ensemble forecast, compute its CRPS and corresponded two-term decomposition.
     
-    CRPS, MAE, pairwise_abs_diff = CRPS_1d(y_true, y_ens)
+    CRPS, MAE, pairwise_abs_diff = CRPS_1d(y_true, y_ens, device='cpu', pairwise=False, impl='numba')
     
     Grimit, E.P., Gneiting, T., Berrocal, V.J. and Johnson, N.A., 2006. The continuous ranked probability score 
     for circular variables and its application to mesoscale forecast ensemble verification. Quarterly Journal of 
@@ -118,6 +240,13 @@ def CRPS_1d(y_true, y_ens):
     ----------
         y_true: a numpy array with shape=(time, grids) and represents the (observed) truth 
         y_pred: a numpy array with shape=(time, ensemble_members, grids), represents the ensemble forecast
+        device: 'cpu' or 'cuda'. cupy array inputs are always computed on GPU.
+                The GPU path is sort-based, `pairwise` and `impl` only apply to CPU.
+        pairwise: if True, SPREAD is computed from all member pairs on CPU (brute force),
+                  can be used as a reference of the default sort-based results.
+        impl: 'numba' (default) or 'numpy' for the CPU computation. 'numpy' broadcasts all member pairs
+              in one (time, ensemble_members, ensemble_members, grids) array, it is only faster for a few members.
+              'numpy' is always pairwise, `pairwise` selects between the two numba kernels.
     
     Output
     ----------
@@ -126,37 +255,173 @@ def CRPS_1d(y_true, y_ens):
         SPREAD: pairwise absolute difference among ensemble members (not the spread)
         
     '''
-    N_day, EN, N_grids = y_ens.shape
+    if device not in ('cpu', 'cuda'):
+        raise ValueError("device must be 'cpu' or 'cuda'")
+    
+    if device == 'cuda' or (cp is not None and isinstance(y_ens, cp.ndarray)):
+        return CRPS_1d_gpu(y_true, y_ens)
+    
+    if impl not in ('numba', 'numpy'):
+        raise ValueError("impl must be 'numba' or 'numpy'")
+    
+    if impl == 'numpy':
+        return CRPS_1d_np(y_true, y_ens)
+    
+    # numba kernels are compiled for C-contiguous float64
+    y_true = np.ascontiguousarray(y_true, dtype=np.float64)
+    
+    # members as the last (contiguous) dimension
+    y_ens_soa = np.ascontiguousarray(np.moveaxis(y_ens, 1, -1), dtype=np.float64)
+    
+    if pairwise:
+        return CRPS_1d_pairwise_soa(y_true, y_ens_soa)
+    
+    return CRPS_1d_soa(y_true, y_ens_soa)
+
+def CRPS_1d_np(y_true, y_ens):
+    '''
+    Numpy version of CRPS_1d. Pairwise member differences are broadcast
+    in one array of shape=(time, ensemble_members, ensemble_members, grids).
+    Computed in float64, same as the numba version.
+    '''
+    y_true = np.asarray(y_true, dtype=np.float64)
+    y_ens = np.asarray(y_ens, dtype=np.float64)
+    
+    EN = y_ens.shape[1]
+    
+    MAE = np.abs(y_true[:, None, :]-y_ens).mean(axis=1)
+    
+    # one pairwise temporary, abs in-place
+    diff = np.subtract(y_ens[:, :, None, :], y_ens[:, None, :, :])
+    np.abs(diff, out=diff)
+    SPREAD = diff.sum(axis=(1, 2))/(2*EN*EN)
+    CRPS = MAE-SPREAD
+    
+    return CRPS, MAE, SPREAD
+
+def CRPS_1d_gpu(y_true, y_ens):
+    '''
+    Cupy version of CRPS_1d. SPREAD is computed from ensemble members sorted on GPU.
+    
+    Outputs are cupy arrays if `y_ens` is a cupy array, otherwise numpy arrays.
+    '''
+    if cp is None:
+        raise ImportError("CRPS_1d_gpu requires cupy")
+    
+    on_device = isinstance(y_ens, cp.ndarray)
+    
+    yt = cp.asarray(y_true)
+    ye = cp.asarray(y_ens)
+    
+    EN = ye.shape[1]
+    
+    MAE = cp.abs(yt[:, None, :]-ye).mean(axis=1)
+    
+    # sum_ij |x_i - x_j| = 2 * sum_k (2k - EN - 1) * x_(k), k = 1, ..., EN
+    k = cp.arange(1, EN+1, dtype=ye.dtype)
+    SPREAD = cp.einsum('e,deg->dg', 2*k-EN-1, cp.sort(ye, axis=1))/(EN*EN)
+    
+    CRPS = MAE-SPREAD
+    
+    if not on_device:
+        return cp.asnumpy(CRPS), cp.asnumpy(MAE), cp.asnumpy(SPREAD)
+    
+    return CRPS, MAE, SPREAD
+
+@nb.njit('Tuple((f8[:, ::1], f8[:, ::1], f8[:, ::1]))(f8[:, ::1], f8[:, :, ::1])',
+         parallel=True, fastmath=True, cache=True, boundscheck=False)
+def CRPS_1d_soa(y_true, y_ens_soa):
+    '''
+    Numba version of CRPS_1d. SPREAD is computed from sorted ensemble members,
+    which scales as O(EN log EN) per grid point and day.
+    
+    `y_ens_soa` has ensemble members as the last dimension, `shape=(time, grids, ensemble_members)`,
+    so the members of each (time, grid) are contiguous in memory. This layout is preferred for new kernels.
+    '''
+    N_day, N_grids, EN = y_ens_soa.shape
     M = 2*EN*EN
     
     # allocate outputs
+    CRPS = np.empty((N_day, N_grids),); CRPS[...] = np.nan
     MAE = np.empty((N_day, N_grids),); MAE[...] = np.nan
     SPREAD = np.empty((N_day, N_grids),); SPREAD[...] = np.nan
     
     # loop over grid points
-    for n in range(N_grids):
+    for n in prange(N_grids):
+        # per-thread scratch of sorted members, re-used over days
+        ens_sorted = np.empty(EN)
         # loop over days
         for day in range(N_day):
             # calc MAE
-            MAE[day, n] = np.mean(np.abs(y_true[day, n]-y_ens[day, :, n]))
+            y_obs = y_true[day, n]
+            mae_temp = 0.0
+            for e in range(EN):
+                mae_temp += abs(y_obs-y_ens_soa[day, n, e])
+            mae = mae_temp/EN
             # calc SPREAD
-            spread_temp = 0
-            for en1 in range(EN):
-                for en2 in range(EN):
-                    spread_temp += np.abs(y_ens[day, en1, n]-y_ens[day, en2, n])
-            SPREAD[day, n] = spread_temp/M
-            
-    CRPS = MAE-SPREAD
+            # sum_ij |x_i - x_j| = 2 * sum_k (2k - EN - 1) * x_(k), k = 1, ..., EN
+            ens_sorted[:] = y_ens_soa[day, n, :]
+            ens_sorted.sort()
+            spread_temp = 0.0
+            for k in range(EN):
+                spread_temp += (2*(k+1)-EN-1)*ens_sorted[k]
+            spread = 2*spread_temp/M
+            # write all outputs once
+            MAE[day, n] = mae
+            SPREAD[day, n] = spread
+            CRPS[day, n] = mae-spread
+    
+    return CRPS, MAE, SPREAD
+
+@nb.njit('Tuple((f8[:, ::1], f8[:, ::1], f8[:, ::1]))(f8[:, ::1], f8[:, :, ::1])',
+         parallel=True, fastmath=True, cache=True, boundscheck=False)
+def CRPS_1d_pairwise_soa(y_true, y_ens_soa):
+    '''
+    Brute-force version of CRPS_1d_soa. SPREAD sums |x_i - x_j| over all member pairs,
+    with the (EN, EN) loop blocked into PAIRWISE_BLOCK tiles.
+    '''
+    N_day, N_grids, EN = y_ens_soa.shape
+    M = 2*EN*EN
+    B = PAIRWISE_BLOCK
+    
+    # allocate outputs
+    CRPS = np.empty((N_day, N_grids),); CRPS[...] = np.nan
+    MAE = np.empty((N_day, N_grids),); MAE[...] = np.nan
+    SPREAD = np.empty((N_day, N_grids),); SPREAD[...] = np.nan
+    
+    # loop over grid points
+    for n in prange(N_grids):
+        # loop over days
+        for day in range(N_day):
+            ens = y_ens_soa[day, n, :]
+            # calc MAE
+            y_obs = y_true[day, n]
+            mae_temp = 0.0
+            for e in range(EN):
+                mae_temp += abs(y_obs-ens[e])
+            mae = mae_temp/EN
+            # calc SPREAD tile by tile
+            spread_temp = 0.0
+            for e1 in range(0, EN, B):
+                for e2 in range(0, EN, B):
+                    for i in range(e1, min(e1+B, EN)):
+                        x_i = ens[i]
+                        for j in range(e2, min(e2+B, EN)):
+                            spread_temp += abs(x_i-ens[j])
+            spread = spread_temp/M
+            # write all outputs once
+            MAE[day, n] = mae
+            SPREAD[day, n] = spread
+            CRPS[day, n] = mae-spread
     
     return CRPS, MAE, SPREAD
 
-@nb.njit()
-def CRPS_2d(y_true, y_ens, land_mask=None):
+def CRPS_2d(y_true, y_ens, land_mask=None, impl='auto'):
     
     '''
     Given two-dimensional ensemble forecast, compute its CRPS and corresponded two-term decomposition.
     
-    CRPS, MAE, pairwise_abs_diff = CRPS_2d(y_true, y_ens, land_mask='none')
+    CRPS, MAE, pairwise_abs_diff = CRPS_2d(y_true, y_ens, land_mask='none', impl='auto')
     
     Grimit, E.P., Gneiting, T., Berrocal, V.J. and Johnson, N.A., 2006. The continuous ranked probability score 
     for circular variables and its application to mesoscale forecast ensemble verification. Quarterly Journal of 
@@ -170,6 +435,8 @@ def CRPS_2d(y_true, y_ens, land_mask=None):
                    True elements indicate where CRPS will be computed.
                    Positions of False elements will be filled with np.nan
                    *if land_mask='none', all grid points will participate.
+        impl: 'numpy', 'numba', or 'auto'. 'auto' selects 'numpy' if its peak memory (3 float64 copies
+              of `y_ens`) is smaller than CRPS_2D_NP_MAX_BYTES, and 'numba' otherwise.
     
     Output
     ----------
@@ -180,36 +447,111 @@ def CRPS_2d(y_true, y_ens, land_mask=None):
     '''
     
     N_day, EN, Nx, Ny = y_ens.shape
-    M = 2*EN*EN
     
     if land_mask is None:
-        land_mask_ = np.ones((Nx, Ny)) > 0
+        land_mask_ = np.ones((Nx, Ny), dtype=np.bool_)
     else:
-        land_mask_ = land_mask
+        land_mask_ = np.asarray(land_mask)
+        
+    # mask indices are used without bounds checks in CRPS_2d_soa
+    if land_mask_.shape != (Nx, Ny):
+        raise ValueError("land_mask must have shape=(gridx, gridy)={}, got {}".format((Nx, Ny), land_mask_.shape))
     
-    # allocate outputs
-    MAE = np.empty((N_day, Nx, Ny),); MAE[...] = np.nan
-    SPREAD = np.empty((N_day, Nx, Ny),); SPREAD[...] = np.nan
+    if impl == 'auto':
+        impl = 'numpy' if 3*N_day*Nx*Ny*EN*8 < CRPS_2D_NP_MAX_BYTES else 'numba'
+        
+    if impl == 'numpy':
+        return CRPS_2d_np(y_true, y_ens, land_mask_)
+    elif impl != 'numba':
+        raise ValueError("impl must be 'auto', 'numpy', or 'numba'")
+    
+    # linear indices of the grid points that participate
+    idx = np.flatnonzero(land_mask_)
+    
+    # flatten grids, members as the last (contiguous) dimension
+    # numba kernels are compiled for C-contiguous float64
+    y_true_flat = np.ascontiguousarray(y_true, dtype=np.float64).reshape(N_day, Nx*Ny)
+    y_ens_soa = np.ascontiguousarray(np.moveaxis(y_ens, 1, -1), dtype=np.float64).reshape(N_day, Nx*Ny, EN)
+    
+    CRPS, MAE, SPREAD = CRPS_2d_soa(y_true_flat, y_ens_soa, idx)
+    
+    return CRPS.reshape(N_day, Nx, Ny), MAE.reshape(N_day, Nx, Ny), SPREAD.reshape(N_day, Nx, Ny)
+
+def CRPS_2d_np(y_true, y_ens, land_mask):
+    '''
+    Numpy version of CRPS_2d. SPREAD is computed from ensemble members sorted along axis 1.
+    Positions of False `land_mask` elements are filled with np.nan.
+    Computed in float64, same as the numba version.
+    '''
+    y_true = np.asarray(y_true, dtype=np.float64)
+    y_ens = np.asarray(y_ens, dtype=np.float64)
+    
+    EN = y_ens.shape[1]
+    
+    # one difference temporary, abs in-place
+    diff = np.subtract(y_true[:, None, :, :], y_ens)
+    np.abs(diff, out=diff)
+    MAE = diff.mean(axis=1)
+    del diff
+    
+    # sum_ij |x_i - x_j| = 2 * sum_k (2k - EN - 1) * x_(k), k = 1, ..., EN
+    k = np.arange(1, EN+1, dtype=np.float64)
+    SPREAD = np.einsum('e,deij->dij', 2*k-EN-1, np.sort(y_ens, axis=1))/(EN*EN)
     
-    # loop over grid points
-    for i in range(Nx):
-        for j in range(Ny):
-            if land_mask_[i, j]:
-                # loop over days
-                for day in range(N_day):
-                    # calc MAE
-                    MAE[day, i, j] = np.mean(np.abs(y_true[day, i, j]-y_ens[day, :, i, j]))
-                    # calc SPREAD
-                    spread_temp = 0
-                    for en1 in range(EN):
-                        for en2 in range(EN):
-                            spread_temp += np.abs(y_ens[day, en1, i, j]-y_ens[day, en2, i, j])
-                    SPREAD[day, i, j] = spread_temp/M
     CRPS = MAE-SPREAD
+    
+    land_mask = np.asarray(land_mask, dtype=np.bool_)
+    CRPS = np.where(land_mask, CRPS, np.nan)
+    MAE = np.where(land_mask, MAE, np.nan)
+    SPREAD = np.where(land_mask, SPREAD, np.nan)
+    
+    return CRPS, MAE, SPREAD
+
+@nb.njit('Tuple((f8[:, ::1], f8[:, ::1], f8[:, ::1]))(f8[:, ::1], f8[:, :, ::1], i8[::1])',
+         parallel=True, fastmath=True, cache=True, boundscheck=False)
+def CRPS_2d_soa(y_true_flat, y_ens_soa, idx):
+    '''
+    Numba version of CRPS_2d on flattened grids.
+    
+    `y_true_flat` has `shape=(time, grids)`, `y_ens_soa` has `shape=(time, grids, ensemble_members)`,
+    and only the grid points listed in `idx` are computed. Others are filled with np.nan.
+    '''
+    N_day, N_grids, EN = y_ens_soa.shape
+    M = 2*EN*EN
+    
+    # allocate outputs
+    CRPS = np.empty((N_day, N_grids),); CRPS[...] = np.nan
+    MAE = np.empty((N_day, N_grids),); MAE[...] = np.nan
+    SPREAD = np.empty((N_day, N_grids),); SPREAD[...] = np.nan
+    
+    # loop over active grid points
+    for k_grid in prange(len(idx)):
+        n = idx[k_grid]
+        # per-thread scratch of sorted members, re-used over days
+        ens_sorted = np.empty(EN)
+        # loop over days
+        for day in range(N_day):
+            # calc MAE
+            y_obs = y_true_flat[day, n]
+            mae_temp = 0.0
+            for e in range(EN):
+                mae_temp += abs(y_obs-y_ens_soa[day, n, e])
+            mae = mae_temp/EN
+            # calc SPREAD
+            # sum_ij |x_i - x_j| = 2 * sum_k (2k - EN - 1) * x_(k), k = 1, ..., EN
+            ens_sorted[:] = y_ens_soa[day, n, :]
+            ens_sorted.sort()
+            spread_temp = 0.0
+            for k in range(EN):
+                spread_temp += (2*(k+1)-EN-1)*ens_sorted[k]
+            spread = 2*spread_temp/M
+            # write all outputs once
+            MAE[day, n] = mae
+            SPREAD[day, n] = spread
+            CRPS[day, n] = mae-spread
 
     return CRPS, MAE, SPREAD
 
-@nb.njit()
 def CRPS_1d_nan(y_true, y_ens):
     '''
     Given one-dimensional ensemble forecast, compute its CRPS and corresponded two-term decomposition.
@@ -233,43 +575,64 @@ def CRPS_1d_nan(y_true, y_ens):
         SPREAD: pairwise absolute difference among ensemble members (not the spread)
         
     '''
-    N_day, EN, N_grids = y_ens.shape
+    # numba kernels are compiled for C-contiguous float64
+    y_true = np.ascontiguousarray(y_true, dtype=np.float64)
+    
+    # members as the last (contiguous) dimension
+    y_ens_soa = np.ascontiguousarray(np.moveaxis(y_ens, 1, -1), dtype=np.float64)
+    
+    return CRPS_1d_nan_soa(y_true, y_ens_soa)
+
+@nb.njit('Tuple((f8[:, ::1], f8[:, ::1], f8[:, ::1]))(f8[:, ::1], f8[:, :, ::1])',
+         parallel=True, fastmath=FASTMATH_NAN, cache=True, boundscheck=False)
+def CRPS_1d_nan_soa(y_true, y_ens_soa):
+    '''
+    Numba version of CRPS_1d_nan, `y_ens_soa` has `shape=(time, grids, ensemble_members)`.
+    '''
+    N_day, N_grids, EN = y_ens_soa.shape
     M = 2*EN*EN
     
     # allocate outputs
+    CRPS = np.empty((N_day, N_grids),); CRPS[...] = np.nan
     MAE = np.empty((N_day, N_grids),); MAE[...] = np.nan
     SPREAD = np.empty((N_day, N_grids),); SPREAD[...] = np.nan
     
     # loop over grid points
-    for n in range(N_grids):
+    for n in prange(N_grids):
+        # per-thread scratch of sorted members, re-used over days
+        ens_sorted = np.empty(EN)
         # loop over days
         for day in range(N_day):
-            # if obs is nan, then mark result as nan
-            if np.isnan(y_true[day, n]):
-                MAE[day, n] = np.nan
-                SPREAD[day, n] = np.nan
-            else:
+            # if obs is nan, then keep result as nan
+            if not np.isnan(y_true[day, n]):
                 # calc MAE
-                MAE[day, n] = np.mean(np.abs(y_true[day, n]-y_ens[day, :, n]))
+                y_obs = y_true[day, n]
+                mae_temp = 0.0
+                for e in range(EN):
+                    mae_temp += abs(y_obs-y_ens_soa[day, n, e])
+                mae = mae_temp/EN
                 # calc SPREAD
-                spread_temp = 0
-                for en1 in range(EN):
-                    for en2 in range(EN):
-                        spread_temp += np.abs(y_ens[day, en1, n]-y_ens[day, en2, n])
-                SPREAD[day, n] = spread_temp/M
-            
-    CRPS = MAE-SPREAD
+                # sum_ij |x_i - x_j| = 2 * sum_k (2k - EN - 1) * x_(k), k = 1, ..., EN
+                ens_sorted[:] = y_ens_soa[day, n, :]
+                ens_sorted.sort()
+                spread_temp = 0.0
+                for k in range(EN):
+                    spread_temp += (2*(k+1)-EN-1)*ens_sorted[k]
+                spread = 2*spread_temp/M
+                # write all outputs once
+                MAE[day, n] = mae
+                SPREAD[day, n] = spread
+                CRPS[day, n] = mae-spread
     
     return CRPS, MAE, SPREAD
 
 
 
-@nb.njit()
-def BS_binary_1d(y_true, y_ens):
+def BS_binary_1d(y_true, y_ens, device='cpu'):
     '''
     Brier Score.
     
-    BS_binary_1d(y_true, y_ens)
+    BS_binary_1d(y_true, y_ens, device='cpu')
     
     ----------
     Hamill, T.M. and Juras, J., 2006. Measuring forecast skill: Is it real skill 
@@ -280,6 +643,7 @@ def BS_binary_1d(y_true, y_ens):
     ----------
         y_true: determinstic and binary true values. `shape=(obs_time, grid_points)`.
         y_ens: ensemble forecast. `shape=(time, ensemble_memeber, gird_points)`.
+        device: 'cpu' or 'cuda'. cupy array inputs are always computed on GPU.
         
     Output
     ----------
@@ -287,24 +651,49 @@ def BS_binary_1d(y_true, y_ens):
         i.e., not scaled by `ensemble_memeber`, so can be applied for spatial-averaged analysis.
     
     '''
+    if device not in ('cpu', 'cuda'):
+        raise ValueError("device must be 'cpu' or 'cuda'")
     
-    N_days, EN, N_grids = y_ens.shape
+    if device == 'cuda' or (cp is not None and isinstance(y_ens, cp.ndarray)):
+        return BS_binary_1d_gpu(y_true, y_ens)
     
-    # allocation
-    BS = np.empty((N_days, N_grids))
-
-    # loop over initialization days
-    for day in range(N_days):
+    # members as the last dimension, i.e., the core dimension of the gufunc
+    BS = BS_binary_core(np.moveaxis(y_ens, 1, -1), y_true)
 
-        ens_vector = y_ens[day, ...]
-        obs_vector = y_true[day, :]
+    return BS
 
-        for n in range(N_grids):
-            BS[day, n] = (obs_vector[n] - np.sum(ens_vector[:, n])/EN)**2
+@nb.guvectorize(['void(f8[:], f8, f8[:])'], '(e),()->()', cache=True)
+def BS_binary_core(ens, obs, BS):
+    '''
+    Brier Score of one ensemble vector against one obs, broadcast as a numpy gufunc.
+    np.nan in obs or ensemble members propagates to the result.
+    '''
+    EN = ens.shape[0]
+    
+    ens_sum = 0.0
+    for e in range(EN):
+        ens_sum += ens[e]
+        
+    BS[0] = (obs - ens_sum/EN)**2
 
+def BS_binary_1d_gpu(y_true, y_ens):
+    '''
+    Cupy version of BS_binary_1d.
+    
+    Outputs are cupy arrays if `y_ens` is a cupy array, otherwise numpy arrays.
+    '''
+    if cp is None:
+        raise ImportError("BS_binary_1d_gpu requires cupy")
+    
+    on_device = isinstance(y_ens, cp.ndarray)
+    
+    BS = (cp.asarray(y_true) - cp.asarray(y_ens).mean(axis=1))**2
+    
+    if not on_device:
+        return cp.asnumpy(BS)
+    
     return BS
 
-@nb.njit()
 def BS_binary_1d_nan(y_true, y_ens):
     '''
     Brier Score. np.nan will not propagate.
@@ -328,27 +717,13 @@ def BS_binary_1d_nan(y_true, y_ens):
     
     '''
     
-    N_days, EN, N_grids = y_ens.shape
-    
-    # allocation
-    BS = np.empty((N_days, N_grids))
-
-    # loop over initialization days
-    for day in range(N_days):
-
-        ens_vector = y_ens[day, ...]
-        obs_vector = y_true[day, :]
-
-        for n in range(N_grids):
-            if np.isnan(obs_vector[n]):
-                BS[day, n] = np.nan
-            else:
-                BS[day, n] = (obs_vector[n] - np.sum(ens_vector[:, n])/EN)**2
+    # np.nan obs propagates through BS_binary_core
+    BS = BS_binary_core(np.moveaxis(y_ens, 1, -1), y_true)
 
     return BS
 
 
-@nb.njit()
+@nb.njit(cache=True)
 def score_bootstrap_1d(data, bootstrap_n=100):
     '''
     Bootstrapping all dimensions EXCEPT the last dimension of an array.
@@ -397,27 +772,49 @@ def bootstrap_confidence_intervals(rmse_t2m,
     if random_seed is not None:
         np.random.seed(random_seed)
         
-    # call the numba-optimized function
+    # resample days with replacement
     bootstrap_data = bootstrap_core(rmse_t2m, num_bootstrap_samples)
     
-    # Compute confidence intervals outside numba
-    ci_lower = np.quantile(bootstrap_data, lower_quantile, axis=0)
-    ci_upper = np.quantile(bootstrap_data, upper_quantile, axis=0)
+    # compute confidence intervals, both quantiles from one sort
+    q_bounds = np.array([lower_quantile, upper_quantile], dtype=bootstrap_data.dtype)
+    ci_lower, ci_upper = np.quantile(bootstrap_data, q_bounds, axis=0)
     mean_score = np.mean(bootstrap_data, axis=0)
     
     return mean_score, ci_lower, ci_upper
 
-@nb.njit()
-def bootstrap_core(rmse_t2m, num_bootstrap_samples):
+def bootstrap_core(rmse_t2m, num_bootstrap_samples, chunk_size=64):
+    '''
+    Resampling days with replacement. Each bootstrap sample draws `n_days` rows
+    of `rmse_t2m` and averages them over days.
+    
+    Samples are generated in chunks of `chunk_size` to bound the
+    (chunk_size, n_days, n_lead_times) temporary array.
+    
+    Returns:
+    - bootstrap_data: numpy array of shape (num_bootstrap_samples, n_lead_times),
+      float32 if `rmse_t2m` is float32, otherwise float64
+    '''
     n_days, n_lead_times = rmse_t2m.shape
-    bootstrap_data = np.empty((num_bootstrap_samples, n_lead_times))
+    bootstrap_data = np.empty((num_bootstrap_samples, n_lead_times),
+                              dtype=np.result_type(rmse_t2m.dtype, np.float32))
     
-    for i in range(num_bootstrap_samples):
-        ind = np.random.randint(0, n_days)
-        bootstrap_data[i, :] = rmse_t2m[ind, :]  # Shape: (n_days, n_lead_times)
+    for i_start in range(0, num_bootstrap_samples, chunk_size):
+        i_end = min(i_start + chunk_size, num_bootstrap_samples)
+        ind = np.random.randint(0, n_days, size=(i_end - i_start, n_days))
+        bootstrap_data[i_start:i_end, :] = rmse_t2m[ind].mean(axis=1)
         
     return bootstrap_data
 
+def map_pyshtools_serial(func, fields, out):
+    '''
+    Writes `func(fields[i])` to `out[i]` one field at a time under PYSHTOOLS_LOCK.
+    
+    Module-level, so dask's process-based schedulers pickle it by reference, not the lock.
+    '''
+    with PYSHTOOLS_LOCK:
+        for i in range(fields.shape[0]):
+            out[i] = func(fields[i])
+
 def zonal_energy_spectrum_sph(ds_input: xr.Dataset, 
                               varname: str,
                               grid_type: str ='DH',
@@ -432,6 +829,10 @@ def zonal_energy_spectrum_sph(ds_input: xr.Dataset,
     - varname: Name of the variable to compute the spectrum for.
     - grid_type: 'GLQ' or 'DH'
     - rescale: produce m * unit result based on circumference
+    
+    * pyshtools transforms are not thread-safe. They are serialized with a lock,
+      so dask-backed inputs computed with the (default) threaded scheduler run
+      one block at a time. Use a process-based dask scheduler for parallel runs.
 
     Returns:
     - spectrum: xarray.DataArray containing the zonal energy spectrum.
@@ -471,6 +872,42 @@ def zonal_energy_spectrum_sph(ds_input: xr.Dataset,
     # allocate zonal wavenumbers ranges
     zonal_wavenumbers = np.arange(max_wavenum + 1)
 
+    # spherical harmonic expansion without the pyshtools.SHGrid wrapper
+    # grid checks and trimming follow pyshtools.SHGrid.from_array
+    grid_type = grid_type.upper()
+    if grid_type == 'DH':
+        # odd nlat: the south pole row (and the 360E column) are dropped
+        extend = nlat % 2
+        if nlon == 2 * nlat - extend:
+            sampling = 2
+        elif nlon == nlat:
+            sampling = 1
+        else:
+            raise ValueError("DH grid needs nlon=nlat, nlon=2*nlat, or nlon=2*nlat-1")
+            
+        def expand(data_array_2d):
+            return pyshtools.expand.SHExpandDH(data_array_2d[:nlat-extend, :nlon-extend], 
+                                               norm=4, sampling=sampling, lmax_calc=max_wavenum)
+        
+    elif grid_type == 'GLQ':
+        # nlon=2*nlat: the 360E column is dropped
+        if nlon == 2 * nlat:
+            extend = 1
+        elif nlon == 2 * nlat - 1:
+            extend = 0
+        else:
+            raise ValueError("GLQ grid needs nlon=2*nlat-1 or nlon=2*nlat")
+        zeros, weights = pyshtools.expand.SHGLQ(nlat - 1)
+        
+        def expand(data_array_2d):
+            return pyshtools.expand.SHExpandGLQ(data_array_2d[:, :nlon-extend], weights, zeros, 
+                                                norm=4, lmax_calc=max_wavenum)
+    else:
+        raise ValueError("grid_type must be 'DH' or 'GLQ'")
+    
+    # lower-triangular mask of degree l >= order m
+    tri = np.tri(max_wavenum + 1, max_wavenum + 1, k=0)
+
     def compute_power_m(data_array_2d):
         '''
         Computes the power spectrum for a 2D data array using spherical harmonics.
@@ -481,35 +918,56 @@ def zonal_energy_spectrum_sph(ds_input: xr.Dataset,
         Returns:
         - power_m: 1D numpy array of power corresponding to each zonal wavenumber m
         '''
-        # initialize SHGrid
-        grid = pyshtools.SHGrid.from_array(data_array_2d, grid=grid_type)
-        
-        # expand the grid to spherical harmonic coefs
-        coeffs = grid.expand(normalization='ortho', lmax_calc=max_wavenum)
+        # expand the grid to orthonormalized spherical harmonic coefs
+        coeffs = expand(data_array_2d)
 
         # power per degree per order. shape=(lmax+1, lmax+1)
-        coeffs_squared = coeffs.coeffs[0]**2 + coeffs.coeffs[1]**2
-        
-        # allocate power array for each zonal wavenumber m
-        power_m = np.zeros(max_wavenum + 1)
+        coeffs_squared = coeffs[0]**2 + coeffs[1]**2
         
         # sum over degrees l > m for each order m to get the total power
         # -l < m < l
-        for l in range(max_wavenum + 1):
-            power_m[l] = np.sum(coeffs_squared[l:, l])
+        power_m = (coeffs_squared * tri).sum(axis=0)
         
         return power_m
-
-    # xr.apply_ufunc scope
-    spectrum = xr.apply_ufunc(
-        compute_power_m,
-        data,
-        input_core_dims=[['latitude', 'longitude']],
-        output_core_dims=[['zonal_wavenumber']],
-        vectorize=True,
-        dask='parallelized',  # <-- dask parallelization
-        output_dtypes=[float],
-    )
+    
+    def compute_power_m_batch(data_array):
+        '''
+        Applies compute_power_m over all leading dimensions of a (..., nlat, nlon) array.
+        Fields are looped serially under PYSHTOOLS_LOCK; pyshtools transforms are not thread-safe.
+        '''
+        leading_shape = data_array.shape[:-2]
+        data_flat = data_array.reshape(-1, nlat, nlon)
+        
+        power_m = np.empty((data_flat.shape[0], max_wavenum + 1))
+        map_pyshtools_serial(compute_power_m, data_flat, power_m)
+            
+        return power_m.reshape(leading_shape + (max_wavenum + 1,))
+
+    if data.chunks is not None:
+        # dask arrays: xr.apply_ufunc scope, one task per dask block
+        spectrum = xr.apply_ufunc(
+            compute_power_m_batch,
+            data,
+            input_core_dims=[['latitude', 'longitude']],
+            output_core_dims=[['zonal_wavenumber']],
+            dask='parallelized',  # <-- dask parallelization
+            dask_gufunc_kwargs={'output_sizes': {'zonal_wavenumber': max_wavenum + 1}},
+            output_dtypes=[float],
+        )
+    else:
+        # numpy arrays: loop over all fields, then re-build the xarray
+        data = data.transpose(..., 'latitude', 'longitude')
+        power_m = compute_power_m_batch(data.values)
+        
+        # keep coordinates that do not depend on latitude and longitude
+        coords = {name: coord for name, coord in data.coords.items()
+                  if 'latitude' not in coord.dims and 'longitude' not in coord.dims}
+        
+        spectrum = xr.DataArray(power_m,
+                                dims=(*data.dims[:-2], 'zonal_wavenumber'),
+                                coords=coords,
+                                name=data.name,
+                                attrs=data.attrs)
 
     # assign new coordinate 'zonal_wavenumber'
     spectrum = spectrum.assign_coords(zonal_wavenumber=zonal_wavenumbers)